@@ -1,50 +1,181 @@
 #!/usr/bin/env python3
 # Script para instalación de Odoo 18.0 en Proxmox LXC con Ubuntu 24.04
-import os, sys, json, subprocess, re, time, shutil, glob
+import os, sys, codecs, json, subprocess, re, time, shutil, shlex, glob, selectors, socket, tarfile, threading
+from concurrent.futures import ThreadPoolExecutor
 
 # Configuración de colores
-C = {
-    'R': '\033[0;31m', 'G': '\033[0;32m', 'B': '\033[0;34m', 'Y': '\033[1;33m',
-    'C': '\033[0;36m', 'P': '\033[0;35m', 'O': '\033[0;33m', 'N': '\033[0m', 'BOLD': '\033[1m'
-}
+R, G, B, Y = '\033[0;31m', '\033[0;32m', '\033[0;34m', '\033[1;33m'
+C, P, O, N, BOLD = '\033[0;36m', '\033[0;35m', '\033[0;33m', '\033[0m', '\033[1m'
+
+# Prefijos precalculados para los mensajes
+INFO_PFX, SUCCESS_PFX, WARNING_PFX = f"{B}[INFO]{N} ", f"{G}[SUCCESS]{N} ", f"{Y}[WARNING]{N} "
+ERROR_PFX, PROGRESS_PFX = f"{R}[ERROR]{N} ", f"{O}[PROGRESS]{N} "
+CLEAR = "\033[H\033[2J\033[3J"
+
+# Patrones de validación precompilados
+VMID_RE = re.compile(r"^[1-9][0-9]{2}$")
+HOST_RE = re.compile(r"^[a-zA-Z0-9][-a-zA-Z0-9]*$")
+MAC_RE = re.compile(r"^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$")
+USER_RE = re.compile(r"^[a-z][a-z0-9_-]*$")
+
+# Validadores: números e IPv4 se comprueban con funciones implementadas en C en lugar de regex
+def is_uint(value): return value.isascii() and value.isdigit()
+def is_cidr(value): return is_uint(value) and int(value) <= 32
+def is_mac(value): return MAC_RE.match(value) is not None
+def is_ipv4(value):
+    try: socket.inet_pton(socket.AF_INET, value); return True
+    except OSError: return False
 
 # Funciones de utilidad
-def msg(text, type_='INFO', color='B'): print(f"{C[color]}[{type_}]{C['N']} {text}")
-def success(text): msg(text, 'SUCCESS', 'G')
-def warning(text): msg(text, 'WARNING', 'Y')
-def error(text): print(f"{C['R']}[ERROR]{C['N']} {text}", file=sys.stderr)
+def msg(text, prefix=INFO_PFX): sys.stdout.write(f"{prefix}{text}\n")
+def success(text): sys.stdout.write(f"{SUCCESS_PFX}{text}\n")
+def warning(text): sys.stdout.write(f"{WARNING_PFX}{text}\n")
+def error(text): sys.stdout.flush(); sys.stderr.write(f"{ERROR_PFX}{text}\n")
 def error_exit(text): error(text); sys.exit(1)
-def section(title): print(f"\n{C['P']}{C['BOLD']}╔═════════════════════════════════════════════════════════════════╗{C['N']}\n{C['P']}{C['BOLD']}  {title}{C['N']}\n{C['P']}{C['BOLD']}╚═════════════════════════════════════════════════════════════════╝{C['N']}")
-def show_item(label, value=""): print(f"  {C['BOLD']}•{C['N']} {label} {C['C']}{value}{C['N']}")
-def show_group(title): print(f"{C['BOLD']}{title}:{C['N']}")
+def clear_screen(): sys.stdout.write(CLEAR); sys.stdout.flush()
+def section(title): print(f"\n{P}{BOLD}╔═════════════════════════════════════════════════════════════════╗{N}\n{P}{BOLD}  {title}{N}\n{P}{BOLD}╚═════════════════════════════════════════════════════════════════╝{N}")
+def show_item(label, value=""): sys.stdout.write(f"  {BOLD}•{N} {label} {C}{value}{N}\n")
+def show_group(title): sys.stdout.write(f"{BOLD}{title}:{N}\n")
 def ask(prompt, default, validation=None, error_msg="Valor inválido"):
     while True:
-        user_input = input(f"{C['C']}{prompt} [{default}]: {C['N']}").strip() or default
-        if validation is None or re.match(validation, user_input): return user_input
+        user_input = input(f"{C}{prompt} [{default}]: {N}").strip() or default
+        if validation is None or validation(user_input): return user_input
         warning(error_msg)
 def confirm_action(prompt, default): 
     # Formato de opciones basado en el valor predeterminado (Y/n o y/N)
     options = "Y/n" if default.lower().startswith('y') else "y/N"
-    return (input(f"{C['G']}{prompt} ({options}): {C['N']}").strip().lower() or default.lower()).startswith('y')
-def run_command(command, exit_on_error=True, show_output=False):
-    try:
-        result = subprocess.run(command, shell=True, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        if show_output: print(result.stdout)
-        return result.stdout.strip()
-    except subprocess.CalledProcessError as e:
-        if exit_on_error: error_exit(f"Error: {command}\nSalida: {e.stderr}")
+    return (input(f"{G}{prompt} ({options}): {N}").strip().lower() or default.lower()).startswith('y')
+
+# Shell persistente: un único bash de larga duración al que se envían los comandos por stdin.
+# Cada comando se evalúa entrecomillado en una subshell: un error de sintaxis devuelve código 2 en lugar
+# de bloquear la shell, y cd/export/set no se arrastran a los comandos siguientes
+class PersistentShell:
+    def __init__(self, argv=None):
+        self.argv, self.proc, self.lock = argv or ['bash'], None, threading.Lock()
+        self.marker = f"__END_{os.urandom(8).hex()}__"
+
+    def _start(self):
+        if self.proc is None or self.proc.poll() is not None:
+            self.proc = subprocess.Popen(self.argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _finished(self, data):
+        # La última línea completa de cada flujo es el marcador (más el código de salida en stdout)
+        return data.endswith(b"\n") and data[:-1].rpartition(b"\n")[2].startswith(self.marker.encode())
+
+    def run(self, command):
+        # Devuelve (código de salida, stdout, stderr); stdin se redirige para no consumir el de la shell
+        with self.lock:
+            self._start()
+            try:
+                self.proc.stdin.write(f"( eval {shlex.quote(command)} ) </dev/null; __rc=$?; printf '\\n%s\\n' {self.marker} >&2; printf '\\n%s\\n' {self.marker}$__rc\n".encode())
+                self.proc.stdin.flush()
+            except OSError: return 1, "", "La shell persistente no está disponible"
+
+            streams = {self.proc.stdout: b"", self.proc.stderr: b""}
+            with selectors.DefaultSelector() as selector:
+                for stream in streams: selector.register(stream, selectors.EVENT_READ)
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        chunk = os.read(key.fd, 65536)
+                        if not chunk:
+                            # La shell terminó (p. ej. el contenedor aún no está en ejecución)
+                            self.proc.wait()
+                            return 1, "", (streams[self.proc.stderr] + self.proc.stderr.read()).decode(errors='replace')
+                        streams[key.fileobj] += chunk
+                        if self._finished(streams[key.fileobj]): selector.unregister(key.fileobj)
+
+            out, _, status = streams[self.proc.stdout][:-1].rpartition(b"\n")
+            err = streams[self.proc.stderr][:-1].rpartition(b"\n")[0]
+            return int(status[len(self.marker):] or 1), out.decode(errors='replace'), err.decode(errors='replace')
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def close(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.stdin.close(); self.proc.wait()
+
+HOST_SH = PersistentShell()  # Comandos en el host Proxmox
+CT_SH = None                 # Comandos dentro del contenedor (se crea cuando se conoce el ID)
+_worker = threading.local()
+_worker_shells = []
+
+def host_shell():
+    # Los hilos auxiliares usan su propia shell para que las consultas concurrentes no se serialicen
+    if threading.current_thread() is threading.main_thread(): return HOST_SH
+    if not hasattr(_worker, 'sh'):
+        _worker.sh = PersistentShell(); _worker_shells.append(_worker.sh)
+    return _worker.sh
+
+def run_command(command, exit_on_error=True, show_output=False, sh=None):
+    returncode, stdout, stderr = (sh or host_shell()).run(command)
+    if returncode != 0:
+        if exit_on_error: error_exit(f"Error: {command}\nSalida: {stderr}")
         return None
+    if show_output: print(stdout)
+    return stdout.strip()
+
+# Cachés en el host compartidas entre instalaciones
+TEMPLATE_CACHE_DIR = "/var/cache/c3i/templates"
+GIT_CACHE_DIR = "/var/cache/c3i/gitcache"
 
 # Funciones de almacenamiento
-def get_storage_data():
+def get_storage_data(hostname):
     try:
-        hostname = run_command("hostname")
         storage_json = run_command(f"pvesh get /nodes/{hostname}/storage --output-format=json")
         return json.loads(storage_json)
     except Exception as e: error_exit(f"Error al obtener datos de almacenamiento: {str(e)}")
 
-def enable_storage_content(storage, content_type, readable_name, storage_data):
-    storage_info = next((item for item in storage_data if item['storage'] == storage), None)
+def template_exists(storage, template):
+    # pveam lista solo las plantillas (vztmpl) del almacenamiento, sin pasar por la API REST.
+    # Se usa la salida de texto ("local:vztmpl/<plantilla>  <tamaño>"), disponible en todas las versiones.
+    # Se ejecuta en segundo plano durante las preguntas, así que un fallo devuelve None y el aviso
+    # se muestra al recoger el resultado
+    listing = run_command(f"pveam list {storage}", exit_on_error=False)
+    if listing is None: return None
+    return any(line.split()[0].endswith(f"/{template}") for line in listing.splitlines()[1:] if line.strip())
+
+def copy_atomic(src, dst):
+    # Copia a un nombre temporal en el mismo directorio y lo renombra: una copia interrumpida
+    # nunca deja un fichero truncado en la ruta final
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.{os.getpid()}.tmp"
+    try:
+        shutil.copy2(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def ensure_template(storage, template):
+    # Restaura la plantilla desde la caché del host o la descarga y guarda una copia permanente
+    template_path = run_command(f"pvesm path {storage}:vztmpl/{template}", exit_on_error=False)
+    cached_template = os.path.join(TEMPLATE_CACHE_DIR, template)
+    if template_path and os.path.exists(cached_template):
+        msg("Copiando plantilla de Ubuntu 24.04 desde la caché local...")
+        copy_atomic(cached_template, template_path)
+        return
+
+    msg("Descargando plantilla de Ubuntu 24.04...")
+    run_command("pveam update")
+    run_command(f"pveam download {storage} {template}")
+    if template_path and os.path.exists(template_path):
+        copy_atomic(template_path, cached_template)
+
+def update_git_cache(odoo_version):
+    # Repositorio bare superficial de Odoo en el host; el contenedor clona desde él vía file://
+    if shutil.which('git') is None: return False
+    repo = os.path.join(GIT_CACHE_DIR, "odoo18.git")
+    if os.path.isdir(repo):
+        command = f"git -C {repo} fetch --depth=1 origin +{odoo_version}:{odoo_version}"
+    else:
+        os.makedirs(GIT_CACHE_DIR, exist_ok=True)
+        command = f"git clone --bare --depth 1 --single-branch --branch {odoo_version} https://github.com/odoo/odoo {repo}"
+    return run_command(command, exit_on_error=False) is not None
+
+def index_storages(storage_data): return {item['storage']: item for item in storage_data}
+
+def enable_storage_content(storage, content_type, readable_name, storage_by_name, hostname):
+    storage_info = storage_by_name.get(storage)
     if not storage_info: error_exit(f"Almacenamiento '{storage}' no encontrado")
 
     content = storage_info.get('content', '')
@@ -56,16 +187,16 @@ def enable_storage_content(storage, content_type, readable_name, storage_data):
             new_content = f"{content},{content_type}" if content else content_type
             run_command(f"pvesh set /storage/{storage} --content '{new_content}'")
             success(f"Soporte para {readable_name} habilitado en '{storage}'")
-            return get_storage_data()
+            return index_storages(get_storage_data(hostname))
         else: error_exit(f"Se requiere soporte para {readable_name}")
     else:
         msg(f"El almacenamiento '{storage}' ya soporta {readable_name}")
-        return storage_data
+        return storage_by_name
 
-def show_storages(storage_data, storages):
+def show_storages(storage_by_name, storages):
     section("ALMACENAMIENTO DISPONIBLE")
     for index, name in enumerate(storages, 1):
-        info = next((item for item in storage_data if item['storage'] == name), {})
+        info = storage_by_name[name]
         content = info.get('content', '')
         avail, total, used = info.get('avail', 'N/A'), info.get('total', 'N/A'), info.get('used', 'N/A')
         rootdir_support = "SÍ" if "rootdir" in content else "NO"
@@ -75,7 +206,7 @@ def show_storages(storage_data, storages):
         avail_display, total_display, used_display = format_size(avail), format_size(total), format_size(used)
         used_percent = f"{used*100/total:.2f}%" if isinstance(used, (int, float)) and isinstance(total, (int, float)) and total > 0 else "N/A"
 
-        print(f"  {C['BOLD']}{index}) {name}{C['N']}")
+        print(f"  {BOLD}{index}) {name}{N}")
         show_item("Espacio total", total_display)
         show_item("Espacio usado", f"{used_display} ({used_percent})")
         show_item("Espacio disponible", avail_display)
@@ -83,6 +214,22 @@ def show_storages(storage_data, storages):
         show_item("Compatible con plantillas", vztmpl_support)
         print("")
 
+# Obtener configuración de red predeterminada: (IP sugerida, máscara, puerta de enlace)
+def get_default_network():
+    suggested_ip, mask, gateway = "192.168.1.100", "24", "192.168.1.1"
+    try:
+        routes = json.loads(run_command("ip -j route show default", exit_on_error=False) or "[]")
+        if routes:
+            interface, gateway = routes[0]['dev'], routes[0].get('gateway', "")
+            addresses = json.loads(run_command(f"ip -j -f inet addr show {interface}", exit_on_error=False) or "[]")
+            if addresses and addresses[0].get('addr_info'):
+                addr_info = addresses[0]['addr_info'][0]
+                ip_parts = addr_info['local'].split('.')
+                suggested_ip = f"{ip_parts[0]}.{ip_parts[1]}.{ip_parts[2]}.100"
+                mask = str(addr_info['prefixlen'])
+    except Exception: pass
+    return suggested_ip, mask, gateway
+
 # Comprobar módulos personalizados
 def check_custom_modules():
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -93,10 +240,10 @@ def check_custom_modules():
         return [], modules_dir
     
     modules = []
-    for item in os.listdir(modules_dir):
-        module_path = os.path.join(modules_dir, item)
-        if os.path.isdir(module_path) and os.path.exists(os.path.join(module_path, "__manifest__.py")):
-            modules.append(item)
+    with os.scandir(modules_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False) and os.path.exists(os.path.join(entry.path, "__manifest__.py")):
+                modules.append(entry.name)
     
     return modules, modules_dir
 
@@ -115,6 +262,12 @@ warning() {{ echo "[WARNING] $1"; }}
 error() {{ echo "[ERROR] $1"; }}
 progress() {{ echo "[PROGRESS] $1"; }}
 
+# Descargar wkhtmltopdf en segundo plano mientras se ejecutan apt y git
+WKHTML_DEB=wkhtmltox_0.12.6.1-2.jammy_amd64.deb
+WKHTML_URL=https://github.com/wkhtmltopdf/packaging/releases/download/0.12.6.1-2/$WKHTML_DEB
+( cd /tmp && wget -q -O "$WKHTML_DEB" "$WKHTML_URL" ) &
+WKHTML_PID=$!
+
 # Actualizar sistema
 info "Actualizando sistema..."
 apt-get update && DEBIAN_FRONTEND=noninteractive apt-get upgrade -y
@@ -122,21 +275,38 @@ success "Sistema actualizado"
 
 # Instalar requisitos
 info "Instalando dependencias..."
-progress "Instalando paquetes del sistema (1/5)"
-apt-get install -y openssh-server fail2ban python3-pip python3-dev libxml2-dev libxslt1-dev zlib1g-dev libsasl2-dev
-progress "Instalando bibliotecas de desarrollo (2/5)"
-apt-get install -y libldap2-dev build-essential libssl-dev libffi-dev default-libmysqlclient-dev libjpeg-dev libpq-dev
-progress "Instalando bibliotecas de procesamiento de imágenes (3/5)"
-apt-get install -y libjpeg8-dev liblcms2-dev libblas-dev libatlas-base-dev
-progress "Instalando Node.js y npm (4/5)"
-apt-get install -y npm git postgresql python3-venv
-progress "Configurando fail2ban y Node.js (5/5)"
+# Una sola transacción de apt: una resolución de dependencias y una pasada de triggers.
+# Con --no-install-recommends se añaden a mano los recomendados que sí hacen falta: ca-certificates
+# y wget (clon de git y descarga de wkhtmltopdf) y python3-systemd, python3-pyinotify y nftables
+# (backend systemd y acciones de bloqueo de fail2ban)
+progress "Instalando paquetes del sistema, bibliotecas de desarrollo, Node.js, npm y fuentes (1/2)"
+DEBIAN_FRONTEND=noninteractive apt-get install -y --no-install-recommends \\
+    -o Dpkg::Options::=--force-confdef -o Dpkg::Options::=--force-confold \\
+    openssh-server fail2ban python3-pip python3-dev libxml2-dev libxslt1-dev zlib1g-dev libsasl2-dev \\
+    libldap2-dev build-essential libssl-dev libffi-dev default-libmysqlclient-dev libjpeg-dev libpq-dev \\
+    libjpeg8-dev liblcms2-dev libblas-dev libatlas-base-dev \\
+    npm git postgresql python3-venv node-less ca-certificates wget \\
+    python3-systemd python3-pyinotify nftables \\
+    xfonts-75dpi xfonts-base
+progress "Configurando fail2ban y Node.js (2/2)"
 systemctl enable fail2ban
 ln -sf /usr/bin/nodejs /usr/bin/node
 npm install -g less less-plugin-clean-css
-apt-get install -y node-less
 success "Dependencias instaladas"
 
+# Crear usuario de Odoo
+info "Creando usuario del sistema para Odoo..."
+adduser --system --home=/opt/odoo18 --group {odoo_user}
+success "Usuario del sistema creado"
+
+# Clonar Odoo en segundo plano mientras se configura PostgreSQL
+info "Clonando repositorio de Odoo..."
+progress "Descargando código fuente de Odoo (esto puede tardar varios minutos)..."
+# Se usa la caché de git del host (/mnt/gitcache) si está montada; si no, se clona desde GitHub
+su - {odoo_user} -s /bin/bash -c "{{ git -c safe.directory=/mnt/gitcache/odoo18.git clone -q --depth 1 --branch {odoo_version} file:///mnt/gitcache/odoo18.git . 2>/dev/null && git remote set-url origin https://github.com/odoo/odoo; }} || \\
+    GIT_HTTP_LOW_SPEED_LIMIT=1000 GIT_HTTP_LOW_SPEED_TIME=60 git -c protocol.version=2 clone --filter=blob:none --depth 1 --single-branch --branch {odoo_version} https://github.com/odoo/odoo ." &
+GIT_PID=$!
+
 # Configurar PostgreSQL
 info "Configurando PostgreSQL..."
 su - postgres -c "createuser --createdb --username postgres --no-createrole --superuser --pwprompt {odoo_user} << EOF
@@ -145,34 +315,29 @@ su - postgres -c "createuser --createdb --username postgres --no-createrole --su
 EOF"
 success "PostgreSQL configurado"
 
-# Crear usuario de Odoo
-info "Creando usuario del sistema para Odoo..."
-adduser --system --home=/opt/odoo18 --group {odoo_user}
-success "Usuario del sistema creado"
-
-# Clonar Odoo
-info "Clonando repositorio de Odoo..."
-progress "Descargando código fuente de Odoo (esto puede tardar varios minutos)..."
-su - {odoo_user} -s /bin/bash -c "git clone https://www.github.com/odoo/odoo --depth 1 --branch {odoo_version} --single-branch ."
-success "Repositorio de Odoo clonado"
+# El entorno virtual se crea dentro del directorio del clon, así que hay que esperar a git
+wait "$GIT_PID" && success "Repositorio de Odoo clonado" || error "No se pudo clonar el repositorio de Odoo"
 
 # Instalar dependencias de Python
 info "Instalando dependencias de Python..."
 python3 -m venv /opt/odoo18/venv
 cd /opt/odoo18/
 progress "Instalando requisitos de Python en entorno virtual (esto puede tardar varios minutos)..."
-/opt/odoo18/venv/bin/pip install wheel
-/opt/odoo18/venv/bin/pip install -r requirements.txt
+# uv resuelve y descarga en paralelo; si no se puede usar, se recurre a pip
+if /opt/odoo18/venv/bin/pip install -q uv; then
+    /opt/odoo18/venv/bin/uv pip install --python /opt/odoo18/venv/bin/python3 wheel -r requirements.txt
+else
+    /opt/odoo18/venv/bin/pip install --prefer-binary --no-compile wheel -r requirements.txt
+fi
 success "Dependencias de Python instaladas"
 
 # Instalar wkhtmltopdf
 info "Instalando wkhtmltopdf..."
-apt-get install -y xfonts-75dpi xfonts-base
 cd /tmp
-progress "Descargando wkhtmltopdf..."
-wget -q https://github.com/wkhtmltopdf/packaging/releases/download/0.12.6.1-2/wkhtmltox_0.12.6.1-2.jammy_amd64.deb
+progress "Esperando la descarga de wkhtmltopdf..."
+wait "$WKHTML_PID" || wget -q -O "$WKHTML_DEB" "$WKHTML_URL"
 progress "Instalando paquete wkhtmltopdf..."
-dpkg -i wkhtmltox_0.12.6.1-2.jammy_amd64.deb || apt-get install -f -y
+dpkg -i "$WKHTML_DEB" || apt-get install -f -y
 success "wkhtmltopdf instalado"
 
 '''+\
@@ -238,22 +403,22 @@ systemctl enable odoo18.service
 
 success "Instalación de Odoo {odoo_version} completada"
 '''
-    with open('/tmp/odoo_install.sh', 'w') as f:
-        f.write(script_content)
+    return script_content
 
 # Principal
 def main():
+    global CT_SH
     # Pantalla de bienvenida
-    os.system('clear')
-    print(f"{C['Y']}╔═════════════════════════════════════════════════════════════════╗{C['N']}")
-    print(f"{C['Y']}║                   C3i SERVICIOS INFORMÁTICOS                    ║{C['N']}")
-    print(f"{C['Y']}║        INSTALADOR AUTOMATIZADO DE ODOO PARA PROXMOX LXC         ║{C['N']}")
-    print(f"{C['Y']}╚═════════════════════════════════════════════════════════════════╝{C['N']}\n")
-    print(f"{C['C']}Este script instalará Odoo 18.0 en un Proxmox LXC con Ubuntu 24.04{C['N']}\n")
+    clear_screen()
+    print(f"{Y}╔═════════════════════════════════════════════════════════════════╗{N}")
+    print(f"{Y}║                   C3i SERVICIOS INFORMÁTICOS                    ║{N}")
+    print(f"{Y}║        INSTALADOR AUTOMATIZADO DE ODOO PARA PROXMOX LXC         ║{N}")
+    print(f"{Y}╚═════════════════════════════════════════════════════════════════╝{N}\n")
+    print(f"{C}Este script instalará Odoo 18.0 en un Proxmox LXC con Ubuntu 24.04{N}\n")
 
     if not confirm_action("¿Continuar con la instalación?", "Y"):
-        print(f"{C['Y']}Instalación cancelada.{C['N']}"); sys.exit(0)
-    os.system('clear')
+        print(f"{Y}Instalación cancelada.{N}"); sys.exit(0)
+    clear_screen()
 
     # Verificar requisitos
     section("VERIFICACIÓN DE REQUISITOS")
@@ -265,7 +430,13 @@ def main():
     if missing_deps:
         warning(f"Faltantes: {', '.join(missing_deps)}")
         if confirm_action("¿Instalar dependencias faltantes?", "Y"):
-            run_command(f"apt update && apt install -y {' '.join(missing_deps)}")
+            try:
+                # Solo se actualizan las listas de paquetes si la caché de apt tiene más de 24 h
+                pkgcache = '/var/cache/apt/pkgcache.bin'
+                if not os.path.exists(pkgcache) or time.time() - os.path.getmtime(pkgcache) > 86400:
+                    subprocess.run(['apt-get', 'update'], check=True)
+                subprocess.run(['apt-get', 'install', '-y', '--no-install-recommends', *missing_deps], check=True)
+            except subprocess.CalledProcessError as e: error_exit(f"Error: {' '.join(e.cmd)}")
         else: error_exit("Dependencias requeridas")
 
     # Verificar módulos personalizados
@@ -280,58 +451,54 @@ def main():
         else:
             error_exit("Se requieren módulos personalizados para esta instalación")
 
+    # Nombre del nodo Proxmox; es invariable, así que se obtiene una sola vez y sin subprocesos
+    hostname = os.uname().nodename
+
+    # Consultas de solo lectura al host en paralelo: solapan la latencia de pvesh/ip
+    executor = ThreadPoolExecutor(max_workers=4)
+    storage_future = executor.submit(get_storage_data, hostname)
+    network_future = executor.submit(get_default_network)
+    template = "ubuntu-24.04-standard_24.04-2_amd64.tar.zst"
+
     # Obtener información de almacenamiento
     msg("Obteniendo almacenamiento disponible...")
-    storage_data = get_storage_data()
-    storages = [item['storage'] for item in storage_data]
+    storage_by_name = index_storages(storage_future.result())
+    storages = list(storage_by_name)
     if not storages: error_exit("No hay almacenamiento disponible")
 
-    show_storages(storage_data, storages)
-    storage_num = int(ask("Seleccione almacenamiento (número)", "1", r"^[0-9]+$"))
+    show_storages(storage_by_name, storages)
+    storage_num = int(ask("Seleccione almacenamiento (número)", "1", is_uint))
     if storage_num < 1 or storage_num > len(storages): error_exit("Selección inválida")
     storage = storages[storage_num - 1]
     success(f"Almacenamiento seleccionado: {storage}")
 
     # Verificar soporte de almacenamiento
-    storage_data = enable_storage_content(storage, "rootdir", "contenedores", storage_data)
-    storage_data = enable_storage_content(storage, "vztmpl", "plantillas", storage_data)
+    storage_by_name = enable_storage_content(storage, "rootdir", "contenedores", storage_by_name, hostname)
+    storage_by_name = enable_storage_content(storage, "vztmpl", "plantillas", storage_by_name, hostname)
+    template_future = executor.submit(template_exists, storage, template)
 
     # Configuración del contenedor
     section("CONFIGURACIÓN DEL CONTENEDOR")
     config = {
-        'vm_id': ask("ID del contenedor (100-999)", "100", r"^[1-9][0-9]{2}$"),
-        'hostname': ask("Nombre de host del contenedor", "odoo-server", r"^[a-zA-Z0-9][-a-zA-Z0-9]*$"),
-        'password': ask("Contraseña de root del contenedor", "Cambiame123", r"."),
-        'memory': ask("RAM (MB, mín 2048)", "4096", r"^[0-9]+$"),
-        'disk': ask("Disco (GB, mín 10)", "20", r"^[0-9]+$"),
-        'cores': ask("Núcleos de CPU", "2", r"^[0-9]+$"),
+        'vm_id': ask("ID del contenedor (100-999)", "100", VMID_RE.match),
+        'hostname': ask("Nombre de host del contenedor", "odoo-server", HOST_RE.match),
+        'password': ask("Contraseña de root del contenedor", "Cambiame123", bool),
+        'memory': ask("RAM (MB, mín 2048)", "4096", is_uint),
+        'disk': ask("Disco (GB, mín 10)", "20", is_uint),
+        'cores': ask("Núcleos de CPU", "2", is_uint),
     }
 
     # Configuración de red
     section("CONFIGURACIÓN DE RED")
     use_public_ip = confirm_action("¿Usar IP pública?", "N")
 
-    # Obtener configuración de red predeterminada
-    try:
-        default_gateway = ""
-        default_interface = run_command("ip route | grep default | awk '{print $5}'", exit_on_error=False)
-        if default_interface:
-            default_cidr = run_command(f"ip -f inet addr show {default_interface} | grep -Po 'inet \\K[\\d.]+/[\\d]+'", exit_on_error=False)
-            if default_cidr:
-                ip_parts = default_cidr.split('/')[0].split('.')
-                default_suggested_ip = f"{ip_parts[0]}.{ip_parts[1]}.{ip_parts[2]}.100"
-                default_mask = default_cidr.split('/')[1]
-                default_gateway = run_command("ip route | grep default | awk '{print $3}'", exit_on_error=False)
-        else:
-            default_suggested_ip, default_mask, default_gateway = "192.168.1.100", "24", "192.168.1.1"
-    except:
-        default_suggested_ip, default_mask, default_gateway = "192.168.1.100", "24", "192.168.1.1"
+    default_suggested_ip, default_mask, default_gateway = network_future.result()
 
     if use_public_ip:
         config.update({
-            'ip_address': ask("Dirección IP pública", "", r"^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$"),
+            'ip_address': ask("Dirección IP pública", "", is_ipv4),
             'netmask': "32",
-            'gateway': ask("Puerta de enlace", default_gateway, r"^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$"),
+            'gateway': ask("Puerta de enlace", default_gateway, is_ipv4),
             'dns_servers': ask("Servidores DNS (separados por coma)", "9.9.9.9,1.1.1.1"),
             'public_ip': True
         })
@@ -339,15 +506,15 @@ def main():
         # Dirección MAC para IP pública
         while True:
             mac = ask("Dirección MAC para IP pública", "", None)
-            if mac and re.match(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$', mac):
+            if mac and is_mac(mac):
                 config['mac_address'] = mac
                 break
             else: error("Se requiere una dirección MAC válida para IP pública")
     else:
         config.update({
-            'ip_address': ask("Dirección IP local", default_suggested_ip, r"^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$"),
-            'netmask': ask("Máscara de red (CIDR)", default_mask, r"^[0-9]+$"),
-            'gateway': ask("Puerta de enlace", default_gateway, r"^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$"),
+            'ip_address': ask("Dirección IP local", default_suggested_ip, is_ipv4),
+            'netmask': ask("Máscara de red (CIDR)", default_mask, is_cidr),
+            'gateway': ask("Puerta de enlace", default_gateway, is_ipv4),
             'dns_servers': ask("Servidores DNS", "9.9.9.9,1.1.1.1"),
             'public_ip': False,
             'mac_address': None
@@ -357,8 +524,8 @@ def main():
     section("CONFIGURACIÓN DE ODOO")
     config.update({
         'odoo_version': "18.0",
-        'odoo_user': ask("Usuario de base de datos de Odoo", "odoo18", r"^[a-z][a-z0-9_-]*$"),
-        'db_password': ask("Contraseña de BD de Odoo", "admin2025", r"."),
+        'odoo_user': ask("Usuario de base de datos de Odoo", "odoo18", USER_RE.match),
+        'db_password': ask("Contraseña de BD de Odoo", "admin2025", bool),
     })
 
     # Resumen
@@ -398,24 +565,21 @@ def main():
     # Crear contenedor
     section("CREACIÓN DEL CONTENEDOR")
     msg("Creando contenedor LXC...")
-    template = "ubuntu-24.04-standard_24.04-2_amd64.tar.zst"
-
-    hostname_cmd = run_command("hostname")
-
-    template_content_json = run_command(f"pvesh get /nodes/{hostname_cmd}/storage/{storage}/content --output-format=json")
-    template_content = json.loads(template_content_json)
-    template_exists = any(item.get('volid', '').endswith(template) for item in template_content)
+    msg("Actualizando en segundo plano la caché de git de Odoo en el host...")
+    git_cache_future = executor.submit(update_git_cache, config['odoo_version'])
+    template_found = template_future.result()
+    if template_found is None: warning(f"No se pudo listar las plantillas de '{storage}' con pveam; se restaurará o descargará la plantilla")
+    if not template_found: ensure_template(storage, template)
 
-    if not template_exists:
-        msg("Descargando plantilla de Ubuntu 24.04...")
-        run_command("pveam update")
-        run_command(f"pveam download {storage} {template}")
+    # La creación del contenedor no espera a la caché de git: solo se monta si ya está lista
+    git_cache_mounted = git_cache_future.done() and git_cache_future.result()
+    if not git_cache_mounted: msg("La caché de git no está lista; el contenedor clonará Odoo desde GitHub")
 
     # Comando para crear contenedor
     create_cmd = (
         f"pct create {config['vm_id']} {storage}:vztmpl/{template} "
-        f"-hostname {config['hostname']} "
-        f"-password {config['password']} "
+        f"-hostname {shlex.quote(config['hostname'])} "
+        f"-password {shlex.quote(config['password'])} "
         f"-ostype ubuntu "
         f"-rootfs {storage}:{config['disk']} "
         f"-memory {config['memory']} "
@@ -428,10 +592,15 @@ def main():
     else:
         create_cmd += f"-net0 name=eth0,bridge=vmbr0,ip={config['ip_address']}/{config['netmask']},gw={config['gateway']} "
 
-    create_cmd += f"-onboot 1 -start 1 -unprivileged 1 -features nesting=1 -nameserver '{config['dns_servers']}'"
+    # Caché de git del host montada en solo lectura
+    if git_cache_mounted:
+        create_cmd += f"-mp0 {GIT_CACHE_DIR},mp=/mnt/gitcache,ro=1 "
+
+    create_cmd += f"-onboot 1 -start 1 -unprivileged 1 -features nesting=1 -nameserver {shlex.quote(config['dns_servers'])}"
 
     run_command(create_cmd)
     success("Contenedor creado")
+    CT_SH = PersistentShell(['pct', 'exec', config['vm_id'], '--', 'bash'])
 
     # Configurar para IP pública /32
     if config['public_ip']:
@@ -450,40 +619,37 @@ network:
         via: 0.0.0.0
   version: 2
 """
-        with open('/tmp/01-netcfg.yaml', 'w') as f:
-            f.write(netplan_config)
-
-        run_command(f"pct push {config['vm_id']} /tmp/01-netcfg.yaml /etc/netplan/01-netcfg.yaml")
-        run_command(f"pct exec {config['vm_id']} -- chmod 644 /etc/netplan/01-netcfg.yaml")
-        run_command(f"pct exec {config['vm_id']} -- bash -c 'rm -f /etc/netplan/10-*.yaml'")
-        run_command(f"pct exec {config['vm_id']} -- netplan apply")
-        run_command("rm /tmp/01-netcfg.yaml")
+        # Escribir la configuración y aplicarla en una sola orden dentro del contenedor
+        run_command(
+            f"cat > /etc/netplan/01-netcfg.yaml <<'EOS'\n{netplan_config}EOS\n"
+            "chmod 644 /etc/netplan/01-netcfg.yaml && rm -f /etc/netplan/10-*.yaml && netplan apply",
+            sh=CT_SH
+        )
 
     # Esperar a que el contenedor se inicie
     msg("Esperando a que el contenedor se inicie...")
     network_check_shown = False
 
-    for attempt in range(30):
-        time.sleep(5)
-
-        status_json = run_command(f"pvesh get /nodes/{hostname_cmd}/lxc/{config['vm_id']}/status/current --output-format=json", exit_on_error=False)
-        if status_json:
-            status_data = json.loads(status_json)
-            status = status_data.get('status')
-
-            if status == "running":
-                if not network_check_shown:
-                    msg("El contenedor está en ejecución, verificando conectividad de red...")
-                    network_check_shown = True
-
-                ping_result = run_command(f"pct exec {config['vm_id']} -- ping -c 1 8.8.8.8", exit_on_error=False)
-                if ping_result is not None:
-                    break
+    # Espera con retroceso exponencial (0,5 s → 4 s) y un único sondeo dentro del contenedor;
+    # "degraded" es habitual en LXC y no impide continuar
+    ready, delay, deadline = False, 0.5, time.monotonic() + 150
+    probe = "systemctl is-system-running 2>/dev/null | grep -qxE 'running|degraded' && ping -c 1 -W 1 8.8.8.8 >/dev/null"
+    while time.monotonic() < deadline:
+        time.sleep(delay)
+        if run_command(probe, exit_on_error=False, sh=CT_SH) is not None:
+            ready = True
+            break
+
+        # La shell del contenedor solo sigue viva si el contenedor está en ejecución
+        if CT_SH.alive() and not network_check_shown:
+            msg("El contenedor está en ejecución, verificando conectividad de red...")
+            network_check_shown = True
 
         print(".", end="", flush=True)
+        delay = min(delay * 2, 4)
     print("")
 
-    if attempt >= 29:
+    if not ready:
         warning("La conectividad de red podría ser limitada. Continuando de todos modos...")
 
     success("Red OK, contenedor iniciado")
@@ -493,65 +659,91 @@ network:
         section("CONFIGURACIÓN DE MÓDULOS PERSONALIZADOS")
         msg("Copiando módulos personalizados al contenedor...")
         
-        # Crear un directorio temporal en el contenedor
-        run_command(f"pct exec {config['vm_id']} -- mkdir -p /tmp/custom_modules")
-        
-        # Copiar cada módulo al contenedor
+        # Transferir todos los módulos en un único tar sin comprimir generado con tarfile y enviado
+        # por tubería al tar del contenedor, que crea antes el directorio temporal. Los propietarios
+        # no se conservan: el script de instalación hace chown de los módulos
+        extract_proc = subprocess.Popen(['pct', 'exec', config['vm_id'], '--', 'bash', '-c', 'mkdir -p /tmp/custom_modules && exec tar -xf - --no-same-owner -C /tmp/custom_modules'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        # stderr se lee en un hilo mientras se escribe el archivo; si no, ambos lados se bloquean
+        # cuando el tar del contenedor llena la tubería de errores
+        extract_errors = []
+        stderr_reader = threading.Thread(target=lambda: extract_errors.append(extract_proc.stderr.read()), daemon=True)
+        stderr_reader.start()
+        pack_error = None
+        try:
+            with extract_proc.stdin, tarfile.open(fileobj=extract_proc.stdin, mode='w|') as archive:
+                for module in custom_modules:
+                    archive.add(os.path.join(modules_dir, module), arcname=module)
+        except (OSError, tarfile.TarError) as e: pack_error = e  # Si tar falla en el contenedor la tubería se rompe
+        stderr_reader.join()
+        extract_err = b"".join(extract_errors)
+        if extract_proc.wait() != 0: error_exit(f"Error al extraer los módulos en el contenedor\nSalida: {extract_err.decode(errors='replace')}")
+        if pack_error: error_exit(f"Error al empaquetar los módulos: {str(pack_error)}")
+
         for module in custom_modules:
-            module_path = os.path.join(modules_dir, module)
-            tmp_tar = f"/tmp/{module}.tar.gz"
-            
-            # Crear un archivo tar del módulo
-            run_command(f"tar -czf {tmp_tar} -C {modules_dir} {module}")
-            
-            # Copiar el tar al contenedor
-            run_command(f"pct push {config['vm_id']} {tmp_tar} /tmp/{module}.tar.gz")
-            
-            # Extraer en el contenedor
-            run_command(f"pct exec {config['vm_id']} -- tar -xzf /tmp/{module}.tar.gz -C /tmp/custom_modules")
-            
-            # Limpiar
-            run_command(f"rm {tmp_tar}")
-            run_command(f"pct exec {config['vm_id']} -- rm /tmp/{module}.tar.gz")
-            
             success(f"Módulo '{module}' transferido al contenedor")
 
     # Instalar Odoo
     section("INSTALACIÓN DE ODOO")
     msg(f"Instalando Odoo {config['odoo_version']}...")
-    create_odoo_install_script(config['odoo_version'], config['db_password'], config['odoo_user'], custom_modules)
-    run_command(f"pct push {config['vm_id']} /tmp/odoo_install.sh /root/odoo_install.sh")
-    run_command(f"pct exec {config['vm_id']} -- chmod +x /root/odoo_install.sh")
+    script_content = create_odoo_install_script(config['odoo_version'], config['db_password'], config['odoo_user'], custom_modules)
 
     # Ejecutar el script de instalación con salida en tiempo real
     msg("Iniciando instalación de Odoo (esto puede tardar un tiempo)...")
 
     try:
         process = subprocess.Popen(
-            f"pct exec {config['vm_id']} -- bash /root/odoo_install.sh",
-            shell=True,
+            ['pct', 'exec', config['vm_id'], '--', 'bash', '-s'],
+            stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            bufsize=1,
-            universal_newlines=True
+            bufsize=65536
         )
 
-        # Procesar y mostrar la salida en tiempo real
-        for line in process.stdout:
-            line = line.strip()
-            if "[INFO]" in line:
-                msg(line.replace("[INFO] ", ""), "INFO", "B")
-            elif "[SUCCESS]" in line:
-                success(line.replace("[SUCCESS] ", ""))
-            elif "[WARNING]" in line:
-                warning(line.replace("[WARNING] ", ""))
-            elif "[ERROR]" in line:
-                error(line.replace("[ERROR] ", ""))
-            elif "[PROGRESS]" in line:
-                msg(line.replace("[PROGRESS] ", ""), "PROGRESS", "O")
-            else:
-                print(f"  {line}")
+        # El script se envía por stdin envuelto en un bloque { }: bash lo lee completo antes de
+        # ejecutarlo, así ningún comando del script consume el resto como entrada
+        process.stdin.write(f"{{\n{script_content}\n}}\n".encode())
+        process.stdin.close()
+
+        # Procesar y mostrar la salida en tiempo real, leyendo y decodificando en bloques de 64 KB; la salida
+        # sin etiqueta (apt, pip...) se agrupa hasta 16 líneas o 0,2 s, y los mensajes etiquetados se muestran al momento
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        fd, pending, partial, last_write = process.stdout.fileno(), [], "", time.monotonic()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                # Si no llega nada en 0,2 s se vuelca lo pendiente para no ocultar la salida de los pasos lentos
+                if not selector.select(timeout=0.2 if pending else None):
+                    sys.stdout.write("".join(pending)); pending.clear()
+                    last_write = time.monotonic()
+                    continue
+
+                chunk = os.read(fd, 65536)
+                *lines, partial = (partial + decoder.decode(chunk, final=not chunk)).split("\n")
+                if not chunk and partial: lines.append(partial)
+
+                flush_now = False
+                for line in lines:
+                    line = line.strip()
+                    if "[INFO]" in line:
+                        pending.append(f"{INFO_PFX}{line.replace('[INFO] ', '')}\n"); flush_now = True
+                    elif "[SUCCESS]" in line:
+                        pending.append(f"{SUCCESS_PFX}{line.replace('[SUCCESS] ', '')}\n"); flush_now = True
+                    elif "[WARNING]" in line:
+                        pending.append(f"{WARNING_PFX}{line.replace('[WARNING] ', '')}\n"); flush_now = True
+                    elif "[ERROR]" in line:
+                        sys.stdout.write("".join(pending)); pending.clear()
+                        error(line.replace("[ERROR] ", ""))
+                    elif "[PROGRESS]" in line:
+                        pending.append(f"{PROGRESS_PFX}{line.replace('[PROGRESS] ', '')}\n"); flush_now = True
+                    else:
+                        pending.append(f"  {line}\n")
+
+                if flush_now or len(pending) >= 16 or time.monotonic() - last_write > 0.2:
+                    sys.stdout.write("".join(pending)); pending.clear()
+                    last_write = time.monotonic()
+                if not chunk: break
+        sys.stdout.write("".join(pending))
 
         process.stdout.close()
         return_code = process.wait()
@@ -564,14 +756,19 @@ network:
     except Exception as e:
         error(f"Error durante la instalación: {str(e)}")
 
-    run_command("rm /tmp/odoo_install.sh")
+    CT_SH.close()
+
+    # La caché de git solo se necesita durante la instalación: el montaje impediría migrar el
+    # contenedor y dejaría expuesto un directorio del host
+    if git_cache_mounted and run_command(f"pct set {config['vm_id']} -delete mp0", exit_on_error=False) is None:
+        warning(f"No se pudo retirar el montaje de la caché de git; elimínelo con: pct set {config['vm_id']} -delete mp0")
 
     # Mostrar información final
     section("INSTALACIÓN COMPLETADA")
-    print(f"{C['O']}╔═════════════════════════════════════════════════════════════════╗{C['N']}")
-    print(f"{C['O']}║                   C3i SERVICIOS INFORMÁTICOS                    ║{C['N']}")
-    print(f"{C['O']}║                 INSTALACIÓN DE ODOO COMPLETADA                  ║{C['N']}")
-    print(f"{C['O']}╚═════════════════════════════════════════════════════════════════╝{C['N']}")
+    print(f"{O}╔═════════════════════════════════════════════════════════════════╗{N}")
+    print(f"{O}║                   C3i SERVICIOS INFORMÁTICOS                    ║{N}")
+    print(f"{O}║                 INSTALACIÓN DE ODOO COMPLETADA                  ║{N}")
+    print(f"{O}╚═════════════════════════════════════════════════════════════════╝{N}")
 
     show_group("Información de acceso a Odoo")
     show_item("URL", f"http://{config['ip_address']}:8069")
@@ -590,10 +787,15 @@ network:
         for module in custom_modules:
             show_item("Módulo instalado", module)
         
-        print(f"\n{C['Y']}NOTA: Los módulos personalizados estarán disponibles después de crear la base de datos.{C['N']}")
-        print(f"{C['Y']}      Deberá activarlos desde el menú de Aplicaciones en Odoo.{C['N']}")
+        print(f"\n{Y}NOTA: Los módulos personalizados estarán disponibles después de crear la base de datos.{N}")
+        print(f"{Y}      Deberá activarlos desde el menú de Aplicaciones en Odoo.{N}")
         
-    print(f"\n{C['Y']}NOTA: Espere unos minutos para que Odoo se inicialice completamente.{C['N']}\n")
+    print(f"\n{Y}NOTA: Espere unos minutos para que Odoo se inicialice completamente.{N}\n")
+
+    # Dejar terminar la actualización de la caché de git para las próximas instalaciones
+    if not git_cache_future.done(): msg("Esperando a que termine la actualización de la caché de git de Odoo...")
+    executor.shutdown()
+    for sh in _worker_shells: sh.close()
 
 if __name__ == "__main__":
     main()